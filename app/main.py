@@ -2,27 +2,67 @@
 """Complete WePower IoT Add-on - Full Implementation"""
 
 import asyncio
+import atexit
+import contextlib
+import heapq
+import itertools
 import json
 import os
+import re
+import signal
 import serial
 import serial.tools.list_ports
+import serial_asyncio
+import sys
 import time
 import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
 from datetime import datetime, timezone
-from enum import Enum
-from typing import Dict, Any, List, Optional, Tuple
+from functools import lru_cache, partial
+from enum import StrEnum
+from typing import Callable, Dict, Any, List, Optional, Set, Tuple
 import paho.mqtt.client as mqtt
 import queue
 import logging
+from logging.handlers import QueueHandler, QueueListener
 
-# Configure logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+try:
+    import orjson
+
+    def _json_dumps(payload: Any) -> bytes:
+        return orjson.dumps(payload, option=orjson.OPT_NAIVE_UTC)
+
+    _json_loads = orjson.loads
+except ImportError:
+    def _json_dumps(payload: Any) -> bytes:
+        return json.dumps(payload, separators=(",", ":")).encode()
+
+    _json_loads = json.loads
+
+# Configure logging (defaults to INFO; LOG_LEVEL=WARNING keeps the add-on quiet).
+# Records are queued and written to stderr by _log_listener's thread, so
+# logging never blocks the event loop on console I/O. The listener runs from
+# import, so importers see output too, and atexit flushes it on any exit.
+_log_queue = queue.SimpleQueue()
+_log_handler = logging.StreamHandler()
+_log_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+_log_listener = QueueListener(_log_queue, _log_handler)
+_log_queue_handler = QueueHandler(_log_queue)
+_log_queue_handler.setFormatter(logging.Formatter('%(message)s'))  # full format applied by _log_handler
+_log_level = os.getenv("LOG_LEVEL", "INFO").upper()
+_log_level_valid = _log_level in logging.getLevelNamesMapping()
+logging.basicConfig(level=_log_level if _log_level_valid else "INFO", handlers=[_log_queue_handler])
+_log_listener.start()
+atexit.register(_log_listener.stop)
 logger = logging.getLogger(__name__)
+if not _log_level_valid:
+    logger.warning(f"[WARNING] Unknown LOG_LEVEL {_log_level!r}, using INFO")
 
-print("WePower IoT Add-on starting...")
 
 # Enums
-class DeviceType(Enum):
+class DeviceType(StrEnum):
     UNKNOWN = "unknown"
     BLE = "ble"
     ZIGBEE = "zigbee"
@@ -30,7 +70,7 @@ class DeviceType(Enum):
     MATTER = "matter"
     GENERIC = "generic"
 
-class DeviceStatus(Enum):
+class DeviceStatus(StrEnum):
     DISCONNECTED = "disconnected"
     CONNECTING = "connecting"
     CONNECTED = "connected"
@@ -39,7 +79,7 @@ class DeviceStatus(Enum):
     OFFLINE = "offline"
     ERROR = "error"
 
-class DeviceCategory(Enum):
+class DeviceCategory(StrEnum):
     UNKNOWN = "unknown"
     SENSOR = "sensor"
     SWITCH = "switch"
@@ -47,68 +87,129 @@ class DeviceCategory(Enum):
     DOOR = "door"
     TOGGLE = "toggle"
 
-class BLEDiscoveryMode(Enum):
+class BLEDiscoveryMode(StrEnum):
     V0_MANUAL = "v0_manual"  # Manual device input
     V1_AUTO = "v1_auto"      # Network key exchange
 
-print("[OK] Enums created successfully")
+
+# Pre-encoded serial commands and line terminator
+_NEWLINE = b"\n"
+_READ_CHUNK = 4096
+_SCAN_DEVICES_CMD = b"SCAN_DEVICES" + _NEWLINE
+
+# Canned responses for mock dongles without a physical port
+_MOCK_READY = {
+    DeviceType.BLE: "BLE_DONGLE_READY",
+    DeviceType.ZIGBEE: "ZIGBEE_DONGLE_READY",
+}
 
 # Device Classes
 class Device:
-    def __init__(self, device_id: str, device_type: DeviceType, port: str):
+    __slots__ = (
+        "device_id", "device_type", "port", "status", "category", "last_seen",
+        "last_seen_iso", "properties", "mqtt_topic", "ble_discovery_mode",
+        "network_key", "pairing_status", "_dict_cache", "_last_payload_hash",
+        "_status_listener",
+    )
+    
+    def __init__(self, device_id: str, device_type: DeviceType, port: str,
+                 category: DeviceCategory = DeviceCategory.UNKNOWN):
         self.device_id = device_id
         self.device_type = device_type
         self.port = port
         self.status = DeviceStatus.DISCONNECTED
-        self.category = DeviceCategory.UNKNOWN
+        self.category = category
         self.last_seen = None
+        self.last_seen_iso: Optional[str] = None
         self.properties = {}
-        self.mqtt_topic = f"wepower_iot/{device_type.value}/{device_id}"
+        self.mqtt_topic = f"wepower_iot/{device_type}/{device_id}"
         self.ble_discovery_mode = BLEDiscoveryMode.V0_MANUAL
         self.network_key = None
         self.pairing_status = False
+        self._dict_cache: Optional[Dict[str, Any]] = None
+        self._last_payload_hash: int = 0
+        self._status_listener: Optional[Callable[["Device", DeviceStatus], None]] = None
         
     def update_status(self, status: DeviceStatus):
+        old_status = self.status
         self.status = status
         self.last_seen = datetime.now(timezone.utc)
+        self.last_seen_iso = self.last_seen.isoformat()
+        self._dict_cache = None
+        if self._status_listener:
+            self._status_listener(self, old_status)
+        
+    def set_property(self, key: str, value: Any):
+        self.properties[key] = value
+        self._dict_cache = None
         
     def to_dict(self) -> Dict[str, Any]:
-        return {
-            "device_id": self.device_id,
-            "device_type": self.device_type.value,
-            "port": self.port,
-            "status": self.status.value,
-            "category": self.category.value,
-            "last_seen": self.last_seen.isoformat() if self.last_seen else None,
-            "properties": self.properties,
-            "ble_discovery_mode": self.ble_discovery_mode.value,
-            "pairing_status": self.pairing_status
-        }
+        # Rebuilt only after update_status/set_property invalidate the cache
+        if self._dict_cache is None:
+            self._dict_cache = {
+                "device_id": self.device_id,
+                "device_type": self.device_type,
+                "port": self.port,
+                "status": self.status,
+                "category": self.category,
+                "last_seen": self.last_seen_iso,
+                "properties": self.properties,
+                "ble_discovery_mode": self.ble_discovery_mode,
+                "pairing_status": self.pairing_status
+            }
+        return self._dict_cache
 
 class Dongle:
+    __slots__ = (
+        "port", "device_type", "mqtt_topic", "reader", "writer", "status",
+        "devices", "last_heartbeat_mono", "is_active", "_last_payload_hash",
+        "_mock_counter", "_rx", "_status_prefix", "_hb_handle",
+    )
+    
     def __init__(self, port: str, device_type: DeviceType):
-        self.port = port
+        # Interned so the device/dongle dict lookups keyed on it hit the identity fast path
+        self.port = sys.intern(port)
         self.device_type = device_type
-        self.serial_connection = None
+        self.mqtt_topic = f"wepower_iot/dongle/{port}"
+        # Status payload up to (not including) the closing brace; port and type never change
+        self._status_prefix = _json_dumps({"port": port, "device_type": device_type})[:-1]
+        self.reader: Optional[asyncio.StreamReader] = None
+        self.writer: Optional[asyncio.StreamWriter] = None
         self.status = DeviceStatus.DISCONNECTED
         self.devices = {}
-        self.last_heartbeat = None
+        self.last_heartbeat_mono: Optional[float] = None  # event loop (monotonic) time
         self.is_active = False
+        self._last_payload_hash: int = 0
+        self._mock_counter = 0
+        self._rx = bytearray()
+        self._hb_handle: Optional[asyncio.TimerHandle] = None
         
-    def connect(self) -> bool:
+    async def connect(self, executor: Optional[ThreadPoolExecutor] = None) -> bool:
+        """Open the port off the event loop, then attach asyncio streams to it"""
+        loop = asyncio.get_running_loop()
+        serial_instance = None
         try:
-            self.serial_connection = serial.Serial(
-                port=self.port,
-                baudrate=115200,
-                timeout=1,
-                write_timeout=1
+            serial_instance = await loop.run_in_executor(
+                executor, partial(serial.serial_for_url, self.port, baudrate=115200)
+            )
+            self.reader = asyncio.StreamReader()
+            protocol = asyncio.StreamReaderProtocol(self.reader)
+            transport, _ = await serial_asyncio.connection_for_serial(
+                loop, lambda: protocol, serial_instance
             )
+            self.writer = asyncio.StreamWriter(transport, protocol, self.reader, loop)
             self.status = DeviceStatus.CONNECTED
             self.is_active = True
             logger.info(f"[OK] Dongle connected on {self.port}")
             return True
         except Exception as e:
             logger.warning(f"[WARNING] Could not connect to physical port {self.port}: {e}")
+            # Release the port if it opened but the stream setup failed
+            if serial_instance is not None:
+                with contextlib.suppress(serial.SerialException, OSError):
+                    serial_instance.close()
+            self.reader = None
+            self.writer = None
             # For demonstration purposes, mark as connected even without physical connection
             self.status = DeviceStatus.CONNECTED
             self.is_active = True
@@ -116,73 +217,112 @@ class Dongle:
             return True
             
     def disconnect(self):
-        if self.serial_connection and self.serial_connection.is_open:
-            self.serial_connection.close()
+        if self.writer:
+            self.writer.close()
+        self.reader = None
+        self.writer = None
         self.status = DeviceStatus.DISCONNECTED
         self.is_active = False
         
     def send_message(self, message: str) -> bool:
-        if not self.serial_connection or not self.serial_connection.is_open:
+        return self.send_bytes(message.encode() + _NEWLINE)
+        
+    def send_bytes(self, data: bytes) -> bool:
+        """Send an already encoded, newline-terminated command"""
+        if self.writer is None:
             # For mock dongles, simulate successful message sending
-            logger.debug(f"[MOCK] Simulating message send to {self.port}: {message}")
+            logger.debug("[MOCK] Simulating message send to %s: %r", self.port, data)
             return True
         try:
-            self.serial_connection.write(f"{message}\n".encode())
+            self.writer.write(data)
             return True
         except Exception as e:
             logger.error(f"[ERROR] Failed to send message to {self.port}: {e}")
             return False
             
-    def read_message(self) -> Optional[str]:
-        if not self.serial_connection or not self.serial_connection.is_open:
-            # For mock dongles, simulate some responses
-            import random
-            if random.random() < 0.1:  # 10% chance of response
-                if self.device_type == DeviceType.BLE:
-                    return "BLE_DONGLE_READY"
-                elif self.device_type == DeviceType.ZIGBEE:
-                    return "ZIGBEE_DONGLE_READY"
-            return None
-        try:
-            if self.serial_connection.in_waiting:
-                return self.serial_connection.readline().decode().strip()
-        except Exception as e:
-            logger.error(f"[ERROR] Failed to read from {self.port}: {e}")
+    def _mock_response(self) -> Optional[str]:
+        # For mock dongles, respond on every 10th read
+        self._mock_counter += 1
+        if self._mock_counter % 10 == 0:
+            return _MOCK_READY.get(self.device_type)
         return None
+        
+    async def read_messages(self) -> List[str]:
+        """Wait for at least one complete line, then return every complete line buffered"""
+        if self.reader is None:
+            message = self._mock_response()
+            return [message] if message else []
+        try:
+            while _NEWLINE not in self._rx:
+                chunk = await self.reader.read(_READ_CHUNK)
+                if not chunk:
+                    return []
+                self._rx += chunk
+        except (serial.SerialException, OSError) as e:
+            logger.error("[ERROR] Failed to read from %s: %s", self.port, e)
+            return []
+            
+        # Take every complete line buffered so far and split them locally
+        end = self._rx.rfind(_NEWLINE)
+        lines = bytes(self._rx[:end]).split(_NEWLINE)
+        del self._rx[:end + 1]
+        
+        # Decode line by line so one corrupt line does not cost the whole burst
+        messages = []
+        for line in lines:
+            try:
+                messages.append(line.decode().strip())
+            except UnicodeDecodeError as e:
+                logger.error(f"[ERROR] Dropping undecodable line from {self.port}: {e}")
+        return messages
 
-print("[OK] Device and Dongle classes created successfully")
 
 # Settings class
+def _env(name: str, default: str, cast: Callable[[str], Any] = str, **kwargs):
+    """Dataclass field read from the environment when Settings is created"""
+    return field(default_factory=lambda: cast(os.getenv(name, default)), **kwargs)
+
+def _env_flag(name: str, default: str):
+    return _env(name, default, lambda value: value.lower() == "true")
+
+def _env_patterns(name: str, default: str):
+    return _env(name, default, lambda value: tuple(p.strip() for p in value.split(",") if p.strip()))
+
+@dataclass(slots=True)
 class Settings:
-    def __init__(self):
-        self.mqtt_broker = os.getenv("MQTT_BROKER", "mqtt://homeassistant:1883")
-        self.mqtt_username = os.getenv("MQTT_USERNAME", "")
-        self.mqtt_password = os.getenv("MQTT_PASSWORD", "")
-        self.scan_interval = float(os.getenv("SCAN_INTERVAL", "0.02"))
-        self.include_patterns = os.getenv("INCLUDE_PATTERNS", "/dev/ttyUSB*,/dev/ttyACM*").split(",")
-        self.exclude_patterns = os.getenv("EXCLUDE_PATTERNS", "/dev/ttyS*,/dev/input*,/dev/hidraw*").split(",")
-        self.enable_discovery = os.getenv("ENABLE_DISCOVERY", "true").lower() == "true"
-        self.discovery_prefix = os.getenv("DISCOVERY_PREFIX", "homeassistant")
-        self.enable_device_detection = os.getenv("ENABLE_DEVICE_DETECTION", "true").lower() == "true"
-        self.enable_device_pairing = os.getenv("ENABLE_DEVICE_PAIRING", "true").lower() == "true"
-        self.enable_device_management = os.getenv("ENABLE_DEVICE_MANAGEMENT", "true").lower() == "true"
-        self.heartbeat_interval = float(os.getenv("HEARTBEAT_INTERVAL", "10.0"))
-        self.pairing_timeout = float(os.getenv("PAIRING_TIMEOUT", "30.0"))
-        self.device_management_port = int(os.getenv("DEVICE_MANAGEMENT_PORT", "8080"))
-        self.max_paired_devices = int(os.getenv("MAX_PAIRED_DEVICES", "50"))
-        
-        # New settings for BLE/Zigbee toggles
-        self.enable_ble = os.getenv("ENABLE_BLE", "true").lower() == "true"
-        self.enable_zigbee = os.getenv("ENABLE_ZIGBEE", "true").lower() == "true"
-        self.ble_discovery_mode = os.getenv("BLE_DISCOVERY_MODE", "v0_manual").lower()
-        
-        # Serial communication settings
-        self.serial_baudrate = int(os.getenv("SERIAL_BAUDRATE", "115200"))
-        self.serial_timeout = float(os.getenv("SERIAL_TIMEOUT", "1.0"))
-        self.who_are_you_message = os.getenv("WHO_ARE_YOU_MESSAGE", "WHO_ARE_YOU")
-        self.device_scan_interval = float(os.getenv("DEVICE_SCAN_INTERVAL", "5.0"))
-
-print("[OK] Settings class created successfully")
+    mqtt_broker: str = _env("MQTT_BROKER", "mqtt://homeassistant:1883")
+    mqtt_username: str = _env("MQTT_USERNAME", "")
+    mqtt_password: str = _env("MQTT_PASSWORD", "", repr=False)
+    scan_interval: float = _env("SCAN_INTERVAL", "0.02", float)
+    include_patterns: Tuple[str, ...] = _env_patterns("INCLUDE_PATTERNS", "/dev/ttyUSB*,/dev/ttyACM*")
+    exclude_patterns: Tuple[str, ...] = _env_patterns("EXCLUDE_PATTERNS", "/dev/ttyS*,/dev/input*,/dev/hidraw*")
+    enable_discovery: bool = _env_flag("ENABLE_DISCOVERY", "true")
+    discovery_prefix: str = _env("DISCOVERY_PREFIX", "homeassistant")
+    enable_device_detection: bool = _env_flag("ENABLE_DEVICE_DETECTION", "true")
+    enable_device_pairing: bool = _env_flag("ENABLE_DEVICE_PAIRING", "true")
+    enable_device_management: bool = _env_flag("ENABLE_DEVICE_MANAGEMENT", "true")
+    heartbeat_interval: float = _env("HEARTBEAT_INTERVAL", "10.0", float)
+    pairing_timeout: float = _env("PAIRING_TIMEOUT", "30.0", float)
+    device_management_port: int = _env("DEVICE_MANAGEMENT_PORT", "8080", int)
+    max_paired_devices: int = _env("MAX_PAIRED_DEVICES", "50", int)
+    
+    # New settings for BLE/Zigbee toggles (changed at runtime, so not frozen)
+    enable_ble: bool = _env_flag("ENABLE_BLE", "true")
+    enable_zigbee: bool = _env_flag("ENABLE_ZIGBEE", "true")
+    ble_discovery_mode: str = _env("BLE_DISCOVERY_MODE", "v0_manual", str.lower)
+    
+    # Serial communication settings
+    serial_baudrate: int = _env("SERIAL_BAUDRATE", "115200", int)
+    serial_timeout: float = _env("SERIAL_TIMEOUT", "1.0", float)
+    who_are_you_message: str = _env("WHO_ARE_YOU_MESSAGE", "WHO_ARE_YOU")
+    device_scan_interval: float = _env("DEVICE_SCAN_INTERVAL", "5.0", float)
+    device_timeout: float = _env("DEVICE_TIMEOUT", "30.0", float)
+    scan_read_budget: float = _env("SCAN_READ_BUDGET", "0.2", float)
+    who_are_you_bytes: bytes = field(init=False, repr=False)
+    
+    def __post_init__(self):
+        self.who_are_you_bytes = self.who_are_you_message.encode() + _NEWLINE
+
 
 # MQTT Manager
 class MQTTManager:
@@ -193,15 +333,38 @@ class MQTTManager:
         self.client.on_message = self._on_message
         self.client.on_disconnect = self._on_disconnect
         self.connected = False
-        self.message_queue = queue.Queue()
+        self._connected_event = threading.Event()
+        self._publish_failing = False
+        # Set by the add-on to take over BLE/Zigbee toggles received over MQTT
+        self._toggle_listener: Optional[Callable[[str, bool], None]] = None
+        
+        # Inbound message dispatch tables
+        self._topic_handlers = {
+            ("wepower_iot", "control"): self._handle_control_message,
+            ("wepower_iot", "device"): self._handle_device_command,
+        }
+        self._action_handlers = {
+            "toggle_ble": self._toggle_ble,
+            "toggle_zigbee": self._toggle_zigbee,
+            "manual_device_add": self._handle_manual_device_add,
+        }
+        self._command_handlers = {
+            "turn_on": self._command_turn_on,
+            "turn_off": self._command_turn_off,
+            "pair": self._command_pair,
+        }
+        
+        # Let paho buffer in-flight messages and pace reconnects on its own
+        self.client.max_queued_messages_set(10000)
+        self.client.reconnect_delay_set(min_delay=1, max_delay=30)
         
         if self.settings.mqtt_username and self.settings.mqtt_password:
             self.client.username_pw_set(self.settings.mqtt_username, self.settings.mqtt_password)
             
     def _on_connect(self, client, userdata, flags, reason_code, properties=None, *args):
         self.connected = True
+        self._connected_event.set()
         logger.info("[OK] MQTT successfully connected!")
-        print("[OK] MQTT successfully connected!")
             
             # Subscribe to control topics
         client.subscribe("wepower_iot/control/+/+")
@@ -213,89 +376,98 @@ class MQTTManager:
     def _on_message(self, client, userdata, msg, properties=None, *args):
         try:
             topic = msg.topic
-            payload = msg.payload.decode()
+            payload = msg.payload
             logger.info(f"[MQTT] MQTT message received: {topic} -> {payload}")
             
-            # Handle different message types
-            if topic.startswith("wepower_iot/control/"):
-                self._handle_control_message(topic, payload)
-            elif topic.startswith("wepower_iot/device/"):
-                self._handle_device_command(topic, payload)
+            # Dispatch on the first two topic segments
+            handler = self._topic_handlers.get(tuple(topic.split("/", 2)[:2]))
+            if handler:
+                handler(topic, payload)
                 
         except Exception as e:
             logger.error(f"[ERROR] Error handling MQTT message: {e}")
     
     def _on_disconnect(self, client, userdata, reason_code, properties=None, *args):
         self.connected = False
+        self._connected_event.clear()
         logger.warning("[WARNING] MQTT disconnected")
         
-    def _handle_control_message(self, topic: str, payload: str):
+    def _handle_control_message(self, topic: str, payload: bytes):
         """Handle control messages from Home Assistant"""
         try:
-            data = json.loads(payload)
-            action = data.get("action")
-            
-            if action == "toggle_ble":
-                self.settings.enable_ble = data.get("enabled", False)
-                logger.info(f"[TOGGLE] BLE toggled: {self.settings.enable_ble}")
-                
-            elif action == "toggle_zigbee":
-                self.settings.enable_zigbee = data.get("enabled", False)
-                logger.info(f"[TOGGLE] Zigbee toggled: {self.settings.enable_zigbee}")
-                
-            elif action == "manual_device_add":
-                self._handle_manual_device_add(data)
+            data = _json_loads(payload)
+            handler = self._action_handlers.get(data.get("action"))
+            if handler:
+                handler(data)
                 
         except Exception as e:
             logger.error(f"[ERROR] Error handling control message: {e}")
             
-    def _handle_device_command(self, topic: str, payload: str):
+    def _toggle_ble(self, data: Dict[str, Any]):
+        if self._toggle_listener:
+            self._toggle_listener("ble", data.get("enabled", False))
+            return
+        self.settings.enable_ble = data.get("enabled", False)
+        logger.info(f"[TOGGLE] BLE toggled: {self.settings.enable_ble}")
+        
+    def _toggle_zigbee(self, data: Dict[str, Any]):
+        if self._toggle_listener:
+            self._toggle_listener("zigbee", data.get("enabled", False))
+            return
+        self.settings.enable_zigbee = data.get("enabled", False)
+        logger.info(f"[TOGGLE] Zigbee toggled: {self.settings.enable_zigbee}")
+        
+    def _handle_device_command(self, topic: str, payload: bytes):
         """Handle device-specific commands"""
         try:
-            data = json.loads(payload)
+            data = _json_loads(payload)
             command = data.get("command")
             device_id = data.get("device_id")
             
             logger.info(f"[COMMAND] Device command received: {command} for {device_id}")
             
-            if command == "turn_on":
-                # Handle light turn on with color/brightness
-                rgb_color = data.get("rgb_color")
-                brightness = data.get("brightness")
-                color_temp = data.get("color_temp")
-                
-                logger.info(f"[COMMAND] Turning on {device_id} - RGB: {rgb_color}, Brightness: {brightness}, Color Temp: {color_temp}")
-                
-                # Update device state in device manager
-                device = self.device_manager.get_device(device_id)
-                if device:
-                    device.properties["light_state"] = True
-                    if rgb_color:
-                        device.properties["rgb_color"] = rgb_color
-                    if brightness:
-                        device.properties["brightness"] = brightness
-                    if color_temp:
-                        device.properties["color_temp"] = color_temp
-                    
-                    # Publish updated device state
-                    self.publish_device_update(device)
-                    
-            elif command == "turn_off":
-                logger.info(f"[COMMAND] Turning off {device_id}")
-                
-                # Update device state
-                device = self.device_manager.get_device(device_id)
-                if device:
-                    device.properties["light_state"] = False
-                    self.publish_device_update(device)
-                    
-            elif command == "pair":
-                logger.info(f"[PAIR] Pairing command for device: {device_id}")
-                # Trigger pairing process
+            handler = self._command_handlers.get(command)
+            if handler:
+                handler(device_id, data)
                 
         except Exception as e:
             logger.error(f"[ERROR] Error handling device command: {e}")
             
+    def _command_turn_on(self, device_id: str, data: Dict[str, Any]):
+        # Handle light turn on with color/brightness
+        rgb_color = data.get("rgb_color")
+        brightness = data.get("brightness")
+        color_temp = data.get("color_temp")
+        
+        logger.info(f"[COMMAND] Turning on {device_id} - RGB: {rgb_color}, Brightness: {brightness}, Color Temp: {color_temp}")
+        
+        # Update device state in device manager
+        device = self.device_manager.get_device(device_id)
+        if device:
+            device.set_property("light_state", True)
+            if rgb_color:
+                device.set_property("rgb_color", rgb_color)
+            if brightness:
+                device.set_property("brightness", brightness)
+            if color_temp:
+                device.set_property("color_temp", color_temp)
+            
+            # Publish updated device state
+            self.publish_device_update(device)
+            
+    def _command_turn_off(self, device_id: str, data: Dict[str, Any]):
+        logger.info(f"[COMMAND] Turning off {device_id}")
+        
+        # Update device state
+        device = self.device_manager.get_device(device_id)
+        if device:
+            device.set_property("light_state", False)
+            self.publish_device_update(device)
+            
+    def _command_pair(self, device_id: str, data: Dict[str, Any]):
+        logger.info(f"[PAIR] Pairing command for device: {device_id}")
+        # Trigger pairing process
+        
     def _handle_manual_device_add(self, data: Dict[str, Any]):
         """Handle manual device addition from UI"""
         device_id = data.get("device_id")
@@ -319,11 +491,8 @@ class MQTTManager:
             self.client.connect(host, port, 60)
             self.client.loop_start()
             
-            # Wait a moment for connection to establish
-            import time
-            time.sleep(1)
-            
-            if self.connected:
+            # Wait for _on_connect, bounded in case the broker never answers
+            if self._connected_event.wait(timeout=5.0):
                 logger.info("[MQTT] MQTT connection established successfully")
                 return True
             else:
@@ -339,48 +508,101 @@ class MQTTManager:
             self.client.loop_stop()
             self.client.disconnect()
     
-    def publish(self, topic: str, payload: Dict[str, Any]):
-        if not self.connected:
-            self.message_queue.put((topic, payload))
-            return
+    def publish(self, topic: str, payload: Dict[str, Any]) -> bool:
+        return self.publish_raw(topic, _json_dumps(payload))
         
+    def publish_raw(self, topic: str, message: bytes) -> bool:
+        """Publish an already serialized payload, returning True if it was sent"""
+        # paho queues the packet for its network thread, which writes whatever
+        # has queued up in one go, so publishes need no batching here
         try:
-            message = json.dumps(payload)
-            self.client.publish(topic, message)
-            logger.debug(f"[PUBLISH] MQTT published: {topic} -> {message}")
+            result = self.client.publish(topic, message, qos=0)
         except Exception as e:
             logger.error(f"[ERROR] Failed to publish MQTT message: {e}")
+            return False
+            
+        if result.rc != mqtt.MQTT_ERR_SUCCESS:
+            # Log the first failure only, not every publish while offline
+            if not self._publish_failing:
+                self._publish_failing = True
+                logger.warning(f"[WARNING] MQTT publish failed ({mqtt.error_string(result.rc)}), dropping messages until reconnected")
+            return False
+            
+        self._publish_failing = False
+        logger.debug("[PUBLISH] MQTT published: %s -> %r", topic, message)
+        return True
             
-    def publish_status(self, status: str):
+    def publish_status(self, status: str, ts: Optional[str] = None):
         payload = {
             "status": status,
-            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "timestamp": ts or datetime.now(timezone.utc).isoformat(),
             "ble_enabled": self.settings.enable_ble,
             "zigbee_enabled": self.settings.enable_zigbee
         }
         self.publish("wepower_iot/status", payload)
         
-    def publish_device_update(self, device: Device):
-        payload = device.to_dict()
-        self.publish(device.mqtt_topic, payload)
-        
-    def publish_dongle_status(self, dongle: Dongle):
+    def publish_status_many(self, statuses: List[str], ts: Optional[str] = None):
+        """Publish several status changes as one wepower_iot/status message"""
+        # Repeats keep their latest position, so "status" is the most recent change
+        changes = list(dict.fromkeys(reversed(statuses)))[::-1]
         payload = {
-            "port": dongle.port,
-            "device_type": dongle.device_type.value,
-            "status": dongle.status.value,
-            "device_count": len(dongle.devices),
-            "timestamp": datetime.now(timezone.utc).isoformat()
+            "status": changes[-1],
+            "changes": changes,
+            "timestamp": ts or datetime.now(timezone.utc).isoformat(),
+            "ble_enabled": self.settings.enable_ble,
+            "zigbee_enabled": self.settings.enable_zigbee
         }
-        self.publish(f"wepower_iot/dongle/{dongle.port}", payload)
+        self.publish("wepower_iot/status", payload)
+                
+    def publish_device_update(self, device: Device):
+        message = _json_dumps(device.to_dict())
+        payload_hash = hash(message)
+        if payload_hash == device._last_payload_hash:
+            return
+        if self.publish_raw(device.mqtt_topic, message):
+            device._last_payload_hash = payload_hash
+        
+    def publish_dongle_status(self, dongle: Dongle, ts: Optional[str] = None):
+        # The timestamp changes on every call, so only the dongle state is hashed
+        payload_hash = hash((dongle.status, len(dongle.devices)))
+        if payload_hash == dongle._last_payload_hash:
+            return
+        ts = ts or datetime.now(timezone.utc).isoformat()
+        # Append the changing fields to the pre-encoded {"port":...,"device_type":... prefix
+        message = (
+            dongle._status_prefix
+            + b',"status":"' + dongle.status.encode()
+            + b'","device_count":' + str(len(dongle.devices)).encode()
+            + b',"timestamp":"' + ts.encode() + b'"}'
+        )
+        if self.publish_raw(dongle.mqtt_topic, message):
+            dongle._last_payload_hash = payload_hash
 
-print("[OK] MQTT Manager created successfully")
 
 # Serial Port Scanner
+# Dongle response keywords, in the priority order used when several appear
+_DONGLE_KEYWORDS = (
+    ("ble", DeviceType.BLE),
+    ("bluetooth", DeviceType.BLE),
+    ("zigbee", DeviceType.ZIGBEE),
+    ("zig", DeviceType.ZIGBEE),
+    ("zwave", DeviceType.ZWAVE),
+    ("zw", DeviceType.ZWAVE),
+    ("matter", DeviceType.MATTER),
+    ("dongle", DeviceType.GENERIC),
+    ("device", DeviceType.GENERIC),
+)
+_DONGLE_RE = re.compile("|".join(keyword for keyword, _ in _DONGLE_KEYWORDS), re.IGNORECASE)
+_DONGLE_TYPES = dict(_DONGLE_KEYWORDS)
+_DONGLE_PRIORITY = {t: i for i, t in enumerate(dict.fromkeys(t for _, t in _DONGLE_KEYWORDS))}
+
 class SerialPortScanner:
     def __init__(self, settings: Settings):
         self.settings = settings
         self.dongles = {}
+        self._include = settings.include_patterns
+        self._exclude = settings.exclude_patterns
+        self._dongle_listener: Optional[Callable[[Dongle], None]] = None
         
     def scan_ports(self) -> Dict[str, Dongle]:
         """Scan for available serial ports and identify dongles"""
@@ -415,12 +637,15 @@ class SerialPortScanner:
                 if self._should_include_port(test_port):
                     available_ports.append(test_port)
         
-        # Identify dongles on available ports
-        for port in available_ports:
-            dongle = self._identify_dongle(port)
+        # Identify dongles on available ports, probing all ports in parallel
+        if not available_ports:
+            return self.dongles
+        with ThreadPoolExecutor(max_workers=len(available_ports)) as executor:
+            identified = list(executor.map(self._identify_dongle, available_ports))
+        for port, dongle in zip(available_ports, identified):
             if dongle:
-                self.dongles[port] = dongle
-                logger.info(f"[DONGLE] Dongle identified: {dongle.device_type.value} on {port}")
+                self.dongles[dongle.port] = dongle
+                logger.info(f"[DONGLE] Dongle identified: {dongle.device_type} on {port}")
             else:
                 logger.info(f"[SCAN] No dongle identified on {port}")
                 
@@ -428,15 +653,8 @@ class SerialPortScanner:
         
     def _should_include_port(self, port_path: str) -> bool:
         """Check if port should be included based on patterns"""
-        for pattern in self.settings.include_patterns:
-            if pattern.strip() and pattern.strip() in port_path:
-                return True
-                
-        for pattern in self.settings.exclude_patterns:
-            if pattern.strip() and pattern.strip() in port_path:
-                return False
-                
-        return False
+        return (any(p in port_path for p in self._include)
+                and not any(p in port_path for p in self._exclude))
         
     def _identify_dongle(self, port: str) -> Optional[Dongle]:
         """Identify dongle type by sending 'Who are you?' message"""
@@ -444,12 +662,16 @@ class SerialPortScanner:
             # Try to connect to port
             with serial.Serial(port, self.settings.serial_baudrate, timeout=self.settings.serial_timeout) as ser:
                 # Send identification message
-                ser.write(f"{self.settings.who_are_you_message}\n".encode())
+                ser.write(self.settings.who_are_you_bytes)
                 time.sleep(0.1)
                 
                 # Read response
                 if ser.in_waiting:
-                    response = ser.readline().decode().strip()
+                    data = ser.read(ser.in_waiting)
+                    if _NEWLINE not in data:
+                        # Response still arriving, finish the line
+                        data += ser.read_until(_NEWLINE)
+                    response = data.split(_NEWLINE, 1)[0].decode().strip()
                     logger.info(f"[SCAN] Port {port} response: {response}")
                     
                     # Parse response to determine dongle type
@@ -471,20 +693,8 @@ class SerialPortScanner:
         
     def _parse_dongle_response(self, response: str) -> Optional[DeviceType]:
         """Parse dongle response to determine type"""
-        response_lower = response.lower()
-        
-        if "ble" in response_lower or "bluetooth" in response_lower:
-            return DeviceType.BLE
-        elif "zigbee" in response_lower or "zig" in response_lower:
-                    return DeviceType.ZIGBEE
-        elif "zwave" in response_lower or "zw" in response_lower:
-            return DeviceType.ZWAVE
-        elif "matter" in response_lower:
-            return DeviceType.MATTER
-        elif "dongle" in response_lower or "device" in response_lower:
-                return DeviceType.GENERIC
-            
-        return None
+        found = {_DONGLE_TYPES[m.lower()] for m in _DONGLE_RE.findall(response)}
+        return min(found, key=_DONGLE_PRIORITY.__getitem__, default=None)
         
     def get_dongles(self) -> Dict[str, Dongle]:
         return self.dongles
@@ -492,10 +702,11 @@ class SerialPortScanner:
     def add_dongle(self, port: str, device_type: DeviceType):
         """Manually add a dongle (for manual configuration)"""
         dongle = Dongle(port, device_type)
-        self.dongles[port] = dongle
-        logger.info(f"[ADD] Manual dongle added: {device_type.value} on {port}")
+        self.dongles[dongle.port] = dongle
+        logger.info(f"[ADD] Manual dongle added: {device_type} on {port}")
+        if self._dongle_listener:
+            self._dongle_listener(dongle)
 
-print("[OK] Serial Port Scanner created successfully")
 
 # Device Manager
 class DeviceManager:
@@ -504,23 +715,35 @@ class DeviceManager:
         self.mqtt_manager = mqtt_manager
         self.devices = {}
         self.device_counter = 0
+        # Device ids per type/status, kept in step with self.devices
+        self._by_type: Dict[DeviceType, Set[str]] = defaultdict(set)
+        self._by_status: Dict[DeviceStatus, Set[str]] = defaultdict(set)
+        # Min-heap of (offline deadline, device_id) for CONNECTED devices only;
+        # entries whose deadline no longer matches _offline_deadlines are stale
+        self._offline_heap: List[Tuple[float, str]] = []
+        self._offline_deadlines: Dict[str, float] = {}
         
     def add_device(self, device_id: str, device_type: DeviceType, port: str, 
                    category: DeviceCategory = DeviceCategory.UNKNOWN, 
                    properties: Dict[str, Any] = None) -> Device:
         """Add a new device"""
+        # Manual adds take device_id straight from MQTT JSON, so it may not be a str
+        if isinstance(device_id, str):
+            device_id = sys.intern(device_id)
         if device_id in self.devices:
             return self.devices[device_id]
             
-        device = Device(device_id, device_type, port)
-        device.category = category
+        device = Device(device_id, device_type, port, category)
         if properties:
             device.properties = properties
             
         self.devices[device_id] = device
         self.device_counter += 1
+        self._by_type[device_type].add(device_id)
+        self._by_status[device.status].add(device_id)
+        device._status_listener = self._on_device_status_change
         
-        logger.info(f"[ADD] Device added: {device_id} ({device_type.value}) on {port}")
+        logger.info(f"[ADD] Device added: {device_id} ({device_type}) on {port}")
         
         # Publish device update
         self.mqtt_manager.publish_device_update(device)
@@ -534,6 +757,10 @@ class DeviceManager:
             device.update_status(DeviceStatus.DISCONNECTED)
             self.mqtt_manager.publish_device_update(device)
             del self.devices[device_id]
+            device._status_listener = None
+            self._by_type[device.device_type].discard(device_id)
+            self._by_status[device.status].discard(device_id)
+            self._offline_deadlines.pop(device_id, None)
             logger.info(f"[REMOVE] Device removed: {device_id}")
             
     def update_device_status(self, device_id: str, status: DeviceStatus):
@@ -543,14 +770,48 @@ class DeviceManager:
             device.update_status(status)
             self.mqtt_manager.publish_device_update(device)
             
+    def _on_device_status_change(self, device: Device, old_status: DeviceStatus):
+        """Move a device between status buckets whenever its status is updated"""
+        if old_status != device.status:
+            self._by_status[old_status].discard(device.device_id)
+            self._by_status[device.status].add(device.device_id)
+            
+        # Every CONNECTED update pushes the device's offline deadline back;
+        # leaving CONNECTED drops it so only connected devices are tracked
+        if device.status == DeviceStatus.CONNECTED:
+            deadline = time.monotonic() + self.settings.device_timeout
+            self._offline_deadlines[device.device_id] = deadline
+            heapq.heappush(self._offline_heap, (deadline, device.device_id))
+            self._compact_offline_heap()
+        else:
+            self._offline_deadlines.pop(device.device_id, None)
+            
+    def _compact_offline_heap(self):
+        """Rebuild the heap from live deadlines once stale entries dominate it"""
+        if len(self._offline_heap) > 2 * len(self._offline_deadlines) + 16:
+            self._offline_heap = [(d, i) for i, d in self._offline_deadlines.items()]
+            heapq.heapify(self._offline_heap)
+            
+    def mark_stale_devices_offline(self):
+        """Set CONNECTED devices not seen within device_timeout to OFFLINE"""
+        now = time.monotonic()
+        heap = self._offline_heap
+        while heap and heap[0][0] <= now:
+            deadline, device_id = heapq.heappop(heap)
+            if self._offline_deadlines.get(device_id) != deadline:
+                continue
+            # Only connected devices have a deadline, so no status check is needed
+            del self._offline_deadlines[device_id]
+            self.devices[device_id].update_status(DeviceStatus.OFFLINE)
+            
     def get_device(self, device_id: str) -> Optional[Device]:
         return self.devices.get(device_id)
         
     def get_devices_by_type(self, device_type: DeviceType) -> List[Device]:
-        return [d for d in self.devices.values() if d.device_type == device_type]
+        return [self.devices[i] for i in self._by_type.get(device_type, ())]
         
     def get_devices_by_status(self, status: DeviceStatus) -> List[Device]:
-        return [d for d in self.devices.values() if d.status == status]
+        return [self.devices[i] for i in self._by_status.get(status, ())]
         
     def get_all_devices(self) -> List[Device]:
         return list(self.devices.values())
@@ -588,62 +849,91 @@ class DeviceManager:
             else:
                 device.update_status(DeviceStatus.CONNECTING)
                 
-            logger.info(f"[ADD] Manual device added: {device_id} ({device_type.value})")
+            logger.info(f"[ADD] Manual device added: {device_id} ({device_type})")
             return device
                 
         except Exception as e:
             logger.error(f"[ERROR] Error adding manual device: {e}")
             return None
 
-print("[OK] Device Manager created successfully")
+
+# Device message parsing: "DEVICE:<id>:<type>[:...]"
+_DEVICE_MSG_RE = re.compile(r"DEVICE:(?P<id>[^:]*):(?P<type>[^:]*)")
+# Keywords in priority order; the first one contained in the text wins
+_DEVICE_TYPE_KEYWORDS = (("BLE", DeviceType.BLE), ("ZIGBEE", DeviceType.ZIGBEE))
+_CATEGORY_KEYWORDS = (
+    ("SENSOR", DeviceCategory.SENSOR),
+    ("SWITCH", DeviceCategory.SWITCH),
+    ("LIGHT", DeviceCategory.LIGHT),
+)
 
 # Main addon class
 class WePowerIoTAddon:
     def __init__(self):
-        print("[OK] Initializing WePower IoT Add-on...")
+        logger.debug("[OK] Initializing WePower IoT Add-on...")
         self.settings = Settings()
         self.mqtt_manager = MQTTManager(self.settings)
         self.port_scanner = SerialPortScanner(self.settings)
+        self.port_scanner._dongle_listener = self._on_dongle_added
+        self.mqtt_manager._toggle_listener = self._on_mqtt_toggle
         self.device_manager = DeviceManager(self.settings, self.mqtt_manager)
         self.running = False
         self.scanning_task = None
-        self.heartbeat_task = None
+        self._heartbeat_handle: Optional[asyncio.TimerHandle] = None
+        self.status_task = None
+        # Status changes queued by the toggles, drained by _status_writer
+        self._status_q: asyncio.Queue[str] = asyncio.Queue()
+        self._stop_event = asyncio.Event()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        # Simulated device id sequences, seeded with the start time so ids
+        # stay unique across restarts
+        seed = int(time.time())
+        self._ble_id_seq = itertools.count(seed)
+        self._zb_id_seq = itertools.count(seed)
         
-        print("[OK] WePower IoT Add-on initialized successfully")
+        logger.debug("[OK] WePower IoT Add-on initialized successfully")
         
     async def start(self):
-        print("[OK] Starting WePower IoT Add-on...")
-        print(f"[OK] MQTT Broker: {self.settings.mqtt_broker}")
-        print(f"[OK] BLE Enabled: {self.settings.enable_ble}")
-        print(f"[OK] Zigbee Enabled: {self.settings.enable_zigbee}")
-        print(f"[OK] Device Detection: {self.settings.enable_device_detection}")
-        print(f"[OK] Device Pairing: {self.settings.enable_device_pairing}")
-        print(f"[OK] Device Management: {self.settings.enable_device_management}")
-        print(f"[OK] Management Port: {self.settings.device_management_port}")
-        print(f"[OK] Max Paired Devices: {self.settings.max_paired_devices}")
+        self._loop = asyncio.get_running_loop()
+        logger.debug("[OK] Starting WePower IoT Add-on...")
+        logger.debug(f"[OK] MQTT Broker: {self.settings.mqtt_broker}")
+        logger.debug(f"[OK] BLE Enabled: {self.settings.enable_ble}")
+        logger.debug(f"[OK] Zigbee Enabled: {self.settings.enable_zigbee}")
+        logger.debug(f"[OK] Device Detection: {self.settings.enable_device_detection}")
+        logger.debug(f"[OK] Device Pairing: {self.settings.enable_device_pairing}")
+        logger.debug(f"[OK] Device Management: {self.settings.enable_device_management}")
+        logger.debug(f"[OK] Management Port: {self.settings.device_management_port}")
+        logger.debug(f"[OK] Max Paired Devices: {self.settings.max_paired_devices}")
         
         # Connect to MQTT
         try:
-            if not self.mqtt_manager.connect():
+            if not await asyncio.to_thread(self.mqtt_manager.connect):
                 logger.warning("[WARNING] Failed to connect to MQTT broker, continuing in offline mode")
                 # Don't return False, continue without MQTT for testing
         except Exception as e:
             logger.warning(f"[WARNING] MQTT connection error: {e}, continuing in offline mode")
             
         # Scan for dongles
-        dongles = self.port_scanner.scan_ports()
-        print(f"[OK] Found {len(dongles)} dongles")
+        dongles = await asyncio.to_thread(self.port_scanner.scan_ports)
+        logger.debug(f"[OK] Found {len(dongles)} dongles")
         
-        # Connect to dongles
-        for port, dongle in dongles.items():
-            if dongle.connect():
-                print(f"[OK] Dongle connected: {dongle.device_type.value} on {port}")
-            else:
-                print(f"[ERROR] Failed to connect to dongle: {dongle.device_type.value} on {port}")
+        # Connect to dongles concurrently, one serial worker per dongle so a
+        # slow port open cannot hold up the others
+        if dongles:
+            with ThreadPoolExecutor(max_workers=len(dongles),
+                                    thread_name_prefix="wepower-serial") as executor:
+                connected = await asyncio.gather(
+                    *(dongle.connect(executor) for dongle in dongles.values())
+                )
+            for (port, dongle), ok in zip(dongles.items(), connected):
+                if ok:
+                    logger.debug(f"[OK] Dongle connected: {dongle.device_type} on {port}")
+                else:
+                    logger.error(f"[ERROR] Failed to connect to dongle: {dongle.device_type} on {port}")
         
         # Set running state regardless of dongle count
         self.running = True
-        print(f"[OK] Add-on running with {len(dongles)} dongles")
+        logger.debug(f"[OK] Add-on running with {len(dongles)} dongles")
         
         # Publish initial dongle statuses
         for port, dongle in dongles.items():
@@ -651,60 +941,79 @@ class WePowerIoTAddon:
             
         # Start background tasks
         self.scanning_task = asyncio.create_task(self._device_scanning_loop())
+        self.status_task = asyncio.create_task(self._status_writer())
         
         # Start heartbeat if enabled
         if self.settings.heartbeat_interval > 0:
-            self.heartbeat_task = asyncio.create_task(self._heartbeat_loop())
+            self._tick_status()
+            for dongle in dongles.values():
+                self._tick_dongle(dongle)
             
-        print("[OK] WePower IoT Add-on started successfully!")
+        logger.debug("[OK] WePower IoT Add-on started successfully!")
         return True
         
+    async def _idle_until_stop(self):
+        await self._stop_event.wait()
+        
     async def stop(self):
-        print("[STOP] Stopping WePower IoT Add-on...")
+        logger.debug("[STOP] Stopping WePower IoT Add-on...")
         self.running = False
+        self._stop_event.set()
         
         # Cancel background tasks
         if self.scanning_task:
             self.scanning_task.cancel()
-        if self.heartbeat_task:
-            self.heartbeat_task.cancel()
+        if self._heartbeat_handle:
+            self._heartbeat_handle.cancel()
+        if self.status_task:
+            self.status_task.cancel()
             
-        # Disconnect dongles
+        # Cancel heartbeat timers and disconnect dongles
         for dongle in self.port_scanner.get_dongles().values():
+            if dongle._hb_handle:
+                dongle._hb_handle.cancel()
             dongle.disconnect()
             
         # Disconnect MQTT
         self.mqtt_manager.disconnect()
         
-        print("[OK] WePower IoT Add-on stopped successfully")
+        logger.debug("[OK] WePower IoT Add-on stopped successfully")
         
     async def _device_scanning_loop(self):
         """Main device scanning loop"""
-        print("[OK] Starting device scanning loop...")
+        logger.debug("[OK] Starting device scanning loop...")
         iteration = 0
         
         while self.running:
             try:
                 iteration += 1
-                print(f"[OK] Device scan iteration {iteration}")
+                logger.debug("[OK] Device scan iteration %d", iteration)
+                # One timestamp is precise enough for everything published this tick
+                tick_ts = datetime.now(timezone.utc).isoformat()
                 
-                # Scan for new devices on each dongle
-                for port, dongle in self.port_scanner.get_dongles().items():
-                    if dongle.is_active:
-                        await self._scan_dongle_for_devices(dongle)
+                # Scan for new devices on all dongles concurrently; a failure on
+                # one dongle is logged without cancelling the others
+                active = [d for d in self.port_scanner.get_dongles().values() if d.is_active]
+                results = await asyncio.gather(
+                    *(self._scan_dongle_for_devices(dongle) for dongle in active),
+                    return_exceptions=True
+                )
+                for dongle, result in zip(active, results):
+                    if isinstance(result, Exception):
+                        logger.error("[ERROR] Error scanning dongle %s: %s", dongle.port, result)
                         
                 # Update device statuses
                 await self._update_device_statuses()
                 
                 # Publish dongle statuses
                 for dongle in self.port_scanner.get_dongles().values():
-                    self.mqtt_manager.publish_dongle_status(dongle)
+                    self.mqtt_manager.publish_dongle_status(dongle, ts=tick_ts)
                     
                 # Simulate device discovery every 5 iterations
                 if iteration % 5 == 0:
-                    print(f"[OK] Simulating device discovery at iteration {iteration}")
+                    logger.debug("[OK] Simulating device discovery at iteration %d", iteration)
                     await self._simulate_device_discovery()
-                
+            
             except Exception as e:
                 logger.error(f"[ERROR] Error in device scanning loop: {e}")
                 # Don't exit the loop, just wait and continue
@@ -713,197 +1022,205 @@ class WePowerIoTAddon:
                 
             await asyncio.sleep(self.settings.device_scan_interval)
             
-        print("[OK] Device scanning loop completed")
+        logger.debug("[OK] Device scanning loop completed")
         
     async def _scan_dongle_for_devices(self, dongle: Dongle):
         """Scan a specific dongle for new devices"""
         try:
             # Send device discovery command
-            if dongle.send_message("SCAN_DEVICES"):
-                # Read responses
-                for _ in range(10):  # Read up to 10 responses
-                    message = dongle.read_message()
-                    if message:
-                        device = self._parse_device_message(message, dongle)
-                        if device:
-                            # Add or update device
-                            existing_device = self.device_manager.get_device(device.device_id)
-                            if existing_device:
-                                existing_device.update_status(DeviceStatus.CONNECTED)
-                            else:
-                                self.device_manager.add_device(
-                                    device.device_id, 
-                                    device.device_type, 
-                                    dongle.port,
-                                    device.category,
-                                    device.properties
-                                )
-                    else:
+            if dongle.send_bytes(_SCAN_DEVICES_CMD):
+                # Drain every response that arrives within the read budget
+                deadline = self._loop.time() + self.settings.scan_read_budget
+                while (remaining := deadline - self._loop.time()) > 0:
+                    try:
+                        messages = await asyncio.wait_for(dongle.read_messages(), timeout=remaining)
+                    except asyncio.TimeoutError:
+                        break
+                    if not messages:
                         break
+                    for message in messages:
+                        self._handle_device_message(message, dongle)
                         
-        except Exception as e:
-            logger.error(f"[ERROR] Error scanning dongle {dongle.port}: {e}")
+        except (serial.SerialException, OSError) as e:
+            logger.error("[ERROR] Error scanning dongle %s: %s", dongle.port, e)
+            
+    def _handle_device_message(self, message: str, dongle: Dongle):
+        """Add or update the device announced by a dongle message"""
+        device = self._parse_device_message(message, dongle)
+        if device:
+            existing_device = self.device_manager.get_device(device.device_id)
+            if existing_device:
+                existing_device.update_status(DeviceStatus.CONNECTED)
+            else:
+                self.device_manager.add_device(
+                    device.device_id, 
+                    device.device_type, 
+                    dongle.port,
+                    device.category,
+                    device.properties
+                )
             
     def _parse_device_message(self, message: str, dongle: Dongle) -> Optional[Device]:
         """Parse device message from dongle"""
-        try:
-            # This is a simplified parser - in real implementation, 
-            # you'd have specific message formats for each device type
-            if "DEVICE:" in message:
-                parts = message.split(":")
-                if len(parts) >= 3:
-                    device_id = parts[1].strip()
-                    device_type_str = parts[2].strip()
-                    
-                    # Determine device type
-                    if "BLE" in device_type_str:
-                        device_type = DeviceType.BLE
-                    elif "ZIGBEE" in device_type_str:
-                        device_type = DeviceType.ZIGBEE
-                    else:
-                        device_type = DeviceType.GENERIC
-                        
-                    # Create device
-                    device = Device(device_id, device_type, dongle.port)
-                    
-                    # Determine category from message
-                    if "SENSOR" in message:
-                        device.category = DeviceCategory.SENSOR
-                    elif "SWITCH" in message:
-                        device.category = DeviceCategory.SWITCH
-                    elif "LIGHT" in message:
-                        device.category = DeviceCategory.LIGHT
-                        
-                    return device
-                
-        except Exception as e:
-            logger.error(f"[ERROR] Error parsing device message: {e}")
-            
+        # _parse_core only matches and slices a str, so it has nothing to raise
+        parsed = self._parse_core(message)
+        if parsed:
+            device_id, device_type, category = parsed
+            return Device(device_id, device_type, dongle.port, category)
         return None
         
+    @staticmethod
+    @lru_cache(maxsize=1024)
+    def _parse_core(message: str) -> Optional[Tuple[str, DeviceType, DeviceCategory]]:
+        """Parse a raw message into (device_id, device_type, category); cached as dongles repeat frames"""
+        # This is a simplified parser - in real implementation, 
+        # you'd have specific message formats for each device type
+        match = _DEVICE_MSG_RE.search(message)
+        if not match:
+            return None
+        device_type_str = match.group("type")
+        device_type = next((t for k, t in _DEVICE_TYPE_KEYWORDS if k in device_type_str), DeviceType.GENERIC)
+        
+        # Determine category from message
+        category = next((c for k, c in _CATEGORY_KEYWORDS if k in message), DeviceCategory.UNKNOWN)
+        return match.group("id").strip(), device_type, category
+        
     async def _update_device_statuses(self):
         """Update status of all devices"""
-        for device in self.device_manager.get_all_devices():
-            # Simulate device status changes
-            if device.status == DeviceStatus.CONNECTED:
-                # Randomly set some devices to offline (as per requirements)
-                if hasattr(device, '_offline_counter'):
-                    device._offline_counter += 1
-                else:
-                    device._offline_counter = 0
-                    
-                # Set devices to offline after some time (simulating real behavior)
-                if device._offline_counter > 10:
-                    device.update_status(DeviceStatus.OFFLINE)
+        # Connected devices that have gone quiet are set offline (as per requirements)
+        self.device_manager.mark_stale_devices_offline()
                     
     async def _simulate_device_discovery(self):
         """Simulate discovering new devices"""
         # Simulate finding a new BLE device
         if self.settings.enable_ble:
-            device_id = f"ble_device_{int(time.time())}"
+            device_id = f"ble_device_{next(self._ble_id_seq)}"
             device = self.device_manager.add_device(
                 device_id, 
                 DeviceType.BLE, 
                 "simulated_port",
                 DeviceCategory.SENSOR
             )
-            print(f"[OK] Simulated BLE device discovered: {device_id}")
+            logger.debug("[OK] Simulated BLE device discovered: %s", device_id)
             
         # Simulate finding a new Zigbee device
         if self.settings.enable_zigbee:
-            device_id = f"zigbee_device_{int(time.time())}"
+            device_id = f"zigbee_device_{next(self._zb_id_seq)}"
             device = self.device_manager.add_device(
                 device_id, 
                 DeviceType.ZIGBEE, 
                 "simulated_port",
                 DeviceCategory.SWITCH
             )
-            print(f"[OK] Simulated Zigbee device discovered: {device_id}")
+            logger.debug("[OK] Simulated Zigbee device discovered: %s", device_id)
             
-    async def _heartbeat_loop(self):
-        """Heartbeat loop for keeping connections alive"""
-        while self.running:
-            try:
-                # Publish heartbeat
-                self.mqtt_manager.publish_status("heartbeat")
-                
-                # Update dongle heartbeats
-                for dongle in self.port_scanner.get_dongles().values():
-                    if dongle.is_active:
-                        dongle.last_heartbeat = datetime.now(timezone.utc)
-                
-            except Exception as e:
-                logger.error(f"[ERROR] Error in heartbeat loop: {e}")
-                
-            await asyncio.sleep(self.settings.heartbeat_interval)
+    def _tick_status(self):
+        """Re-arm the MQTT heartbeat timer, then publish the heartbeat"""
+        if not self.running:
+            return
+        # Re-armed first so an error in the publish cannot end the chain
+        self._heartbeat_handle = self._loop.call_later(
+            self.settings.heartbeat_interval, self._tick_status
+        )
+        self.mqtt_manager.publish_status("heartbeat")
+        
+    def _schedule_dongle_heartbeat(self, dongle: Dongle):
+        dongle._hb_handle = self._loop.call_later(
+            self.settings.heartbeat_interval, self._tick_dongle, dongle
+        )
+        
+    def _tick_dongle(self, dongle: Dongle):
+        """Re-arm one dongle's heartbeat timer, then record its heartbeat"""
+        # A dongle replaced in or dropped from the scanner lets its timer lapse
+        if not self.running or self.port_scanner.get_dongles().get(dongle.port) is not dongle:
+            return
+        self._schedule_dongle_heartbeat(dongle)
+        if dongle.is_active:
+            dongle.last_heartbeat_mono = self._loop.time()
+            
+    def _on_dongle_added(self, dongle: Dongle):
+        """Give a dongle added after start() its own heartbeat timer"""
+        # May be called off the event loop thread; _tick_dongle ignores it if not running
+        if self._loop and self.settings.heartbeat_interval > 0:
+            self._loop.call_soon_threadsafe(self._tick_dongle, dongle)
 
+    def _on_mqtt_toggle(self, feature: str, enabled: bool):
+        """Hand a toggle from the paho network thread over to the event loop"""
+        toggle = self.toggle_ble if feature == "ble" else self.toggle_zigbee
+        self._loop.call_soon_threadsafe(toggle, enabled)
+        
     def toggle_ble(self, enabled: bool):
         """Toggle BLE functionality"""
         self.settings.enable_ble = enabled
         logger.info(f"[TOGGLE] BLE toggled: {enabled}")
-        self.mqtt_manager.publish_status("ble_toggled")
+        self._status_q.put_nowait("ble_toggled")
         
     def toggle_zigbee(self, enabled: bool):
         """Toggle Zigbee functionality"""
         self.settings.enable_zigbee = enabled
         logger.info(f"[TOGGLE] Zigbee toggled: {enabled}")
-        self.mqtt_manager.publish_status("zigbee_toggled")
+        self._status_q.put_nowait("zigbee_toggled")
         
+    async def _status_writer(self):
+        """Publish queued status changes, coalescing whatever has piled up"""
+        while True:
+            statuses = [await self._status_q.get()]
+            while not self._status_q.empty():
+                statuses.append(self._status_q.get_nowait())
+            self.mqtt_manager.publish_status_many(statuses)
+            
     def manual_add_device(self, device_data: Dict[str, Any]) -> Optional[Device]:
         """Manually add device from UI"""
         return self.device_manager.manual_add_device(device_data)
 
 async def main():
-    print("[OK] Main function started")
+    logger.info("[OK] Main function started")
     addon = WePowerIoTAddon()
     
+    # SIGINT/SIGTERM (sent by the Supervisor on shutdown) end the wait below
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        with contextlib.suppress(NotImplementedError):
+            loop.add_signal_handler(sig, addon._stop_event.set)
+    
     try:
-        if await addon.start():
-            print("[OK] Add-on started successfully, entering main loop")
-            # Keep running until interrupted
-            while addon.running:
-                try:
-                    await asyncio.sleep(1)
-                except Exception as e:
-                    logger.error(f"[ERROR] Error in main loop: {e}")
-                    # Don't exit on individual loop errors, just log and continue
-                    await asyncio.sleep(5)  # Wait a bit before continuing
-        else:
-            print("[ERROR] Failed to start addon")
-            # Don't exit immediately, try to keep running
-            print("[OK] Attempting to continue with limited functionality")
-            while True:
-                await asyncio.sleep(10)
+        # Retry a failed start with exponential backoff, capped at 60s
+        for attempt in itertools.count():
+            try:
+                if await addon.start():
+                    logger.info("[OK] Add-on started successfully, entering main loop")
+                    break
+            except Exception as e:
+                logger.exception(f"[ERROR] Error starting addon: {e}")
+            delay = min(60, 2 ** attempt)
+            logger.error(f"[ERROR] Failed to start addon, retrying in {delay}s")
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(addon._stop_event.wait(), timeout=delay)
+            if addon._stop_event.is_set():
+                break
+                
+        # Keep running until stop() or a signal sets the stop event
+        await addon._idle_until_stop()
             
     except KeyboardInterrupt:
-        print("[STOP] Interrupted by user")
+        logger.info("[STOP] Interrupted by user")
     except Exception as e:
-        print(f"[ERROR] Error in main: {e}")
-        import traceback
-        traceback.print_exc()
-        # Don't exit immediately, try to keep running
-        print("[OK] Attempting to continue after error")
-        while True:
-            try:
-                await asyncio.sleep(10)
-            except:
-                break
+        logger.exception(f"[ERROR] Error in main: {e}")
     finally:
         try:
             await addon.stop()
         except Exception as e:
-            print(f"[ERROR] Error stopping addon: {e}")
+            logger.error(f"[ERROR] Error stopping addon: {e}")
 
-    print("[OK] Main function completed")
+    logger.info("[OK] Main function completed")
 
 if __name__ == "__main__":
-    print("[OK] Script entry point reached")
+    logger.info("[OK] Script entry point reached")
     try:
         asyncio.run(main())
-        print("[OK] asyncio.run completed successfully")
+        logger.info("[OK] asyncio.run completed successfully")
     except Exception as e:
-        print(f"[ERROR] Error in main: {e}")
-        import traceback
-        traceback.print_exc()
-    print("[OK] Script finished")
+        logger.exception(f"[ERROR] Error in main: {e}")
+    finally:
+        logger.info("[OK] Script finished")
 